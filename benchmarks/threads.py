@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+"""Stress and throughput benchmark of ``{% formfill %}`` under threads.
+
+Every thread renders the same template from one shared
+:class:`jinja2.Environment`, and each result is compared with the output
+of a single-threaded render.  With ``--mutate``, another thread keeps
+switching ``error_class`` and the ``default`` error formatter, and each
+result must match one of the outputs of those settings.
+
+Throughput is reported for each number of threads, so that scaling can be
+compared between regular and free-threaded CPython builds.  Run it with
+the package importable, e.g. from the repository root::
+
+    $ PYTHONPATH=. python benchmarks/threads.py --threads 1,2,4,8 --renders 500
+
+"""
+from __future__ import print_function
+
+import optparse
+import sys
+import threading
+import timeit
+
+import jinja2
+
+from formencode_jinja2 import formfill
+
+
+TEMPLATE = u'''
+{%- formfill defaults with errors -%}
+<form action="/orders" method="POST">
+{%- for i in range(fields) %}
+    <input type="text" name="items-{{ i }}.qty" />
+    <form:error name="items-{{ i }}.qty">
+{%- endfor %}
+</form>
+{%- endformfill -%}
+'''
+
+
+def make_context(fields):
+    items = [{'qty': i} for i in range(fields)]
+    errors = [{'qty': 'Out of stock'} if i % 10 == 0 else None
+              for i in range(fields)]
+    return {
+        'fields': fields,
+        'defaults': {'items': items},
+        'errors': {'items': errors},
+    }
+
+
+def list_error_formatter(error):
+    return u'<ul class="errors"><li>{0}</li></ul>'.format(error)
+
+
+def make_settings(env):
+    """Return the combinations of settings which ``--mutate`` switches
+    between, all of them changing the rendered output.
+
+    """
+    default_formatter = env.formfill_error_formatters['default']
+    return [(error_class, formatter)
+            for error_class in ('error', 'fail')
+            for formatter in (default_formatter, list_error_formatter)]
+
+
+def apply_settings(env, setting):
+    error_class, formatter = setting
+    env.formfill_config['error_class'] = error_class
+    env.formfill_error_formatters['default'] = formatter
+
+
+def run(template, context, expected, threads, renders, settings=None):
+    """Render ``renders`` times in each of ``threads`` threads, and return
+    the elapsed seconds and the number of results not in ``expected``.
+    If ``settings`` is given, the configuration of the environment is also
+    switched between them while rendering.
+
+    """
+    failures = []
+    start = threading.Event()
+    stop = threading.Event()
+
+    def render():
+        start.wait()
+        for _ in range(renders):
+            if template.render(context) not in expected:
+                failures.append(None)
+
+    def configure():
+        start.wait()
+        while not stop.is_set():
+            for setting in settings:
+                apply_settings(template.environment, setting)
+
+    workers = [threading.Thread(target=render) for _ in range(threads)]
+    mutators = [threading.Thread(target=configure)] if settings else []
+    for thread in workers + mutators:
+        thread.start()
+    begin = timeit.default_timer()
+    start.set()
+    for thread in workers:
+        thread.join()
+    elapsed = timeit.default_timer() - begin
+    stop.set()
+    for thread in mutators:
+        thread.join()
+    return elapsed, len(failures)
+
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('--threads', default='1,2,4,8',
+                      help='comma-separated thread counts [%default]')
+    parser.add_option('--renders', type='int', default=200,
+                      help='renders per thread [%default]')
+    parser.add_option('--fields', type='int', default=100,
+                      help='fields per form [%default]')
+    parser.add_option('--mutate', action='store_true', default=False,
+                      help='modify the configuration while rendering')
+    options, _ = parser.parse_args()
+
+    env = jinja2.Environment(extensions=[formfill])
+    template = env.from_string(TEMPLATE)
+    context = make_context(options.fields)
+    settings = make_settings(env) if options.mutate else None
+    if settings:
+        expected = set()
+        for setting in settings:
+            apply_settings(env, setting)
+            expected.add(template.render(context))
+    else:
+        expected = set([template.render(context)])
+
+    is_gil_enabled = getattr(sys, '_is_gil_enabled', None)
+    print('Python {0}, GIL {1}'.format(
+        sys.version.split()[0],
+        'enabled' if is_gil_enabled is None or is_gil_enabled()
+        else 'disabled'))
+    print('{0:>8} {1:>10} {2:>12} {3:>8} {4:>9}'.format(
+        'threads', 'seconds', 'renders/s', 'scaling', 'failures'))
+    baseline = None
+    failed = False
+    for threads in [int(n) for n in options.threads.split(',')]:
+        elapsed, failures = run(template, context, expected, threads,
+                                options.renders, settings)
+        throughput = threads * options.renders / elapsed
+        if baseline is None:
+            baseline = throughput
+        failed = failed or failures > 0
+        print('{0:>8} {1:>10.3f} {2:>12.1f} {3:>7.2f}x {4:>9}'.format(
+            threads, elapsed, throughput, throughput / baseline, failures))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,11 +1,22 @@
-import collections
+import re
+import timeit
 import formencode.htmlfill
 import jinja2
 import jinja2.ext
 from jinja2 import nodes
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
 
+try:
+    string_types = basestring
+except NameError:
+    string_types = str
 
-__all__ = ['FormFillExtension']
+
+__all__ = ['FormFillExtension', 'FormFillParser', 'NestedMapping', 'render',
+           'warm_up']
 
 
 class FormFillExtension(jinja2.ext.Extension):
@@ -49,9 +60,11 @@ class FormFillExtension(jinja2.ext.Extension):
                      surrounded in the template tag.
                      Keys contain a value of ``name`` attribute of the input
                      field, and values contain its default value.
+                     It may be nested as well; see :class:`NestedMapping`.
     :param errors: a :term:`mapping` that contains error messages of the
                    input fields. this value will also effect ``class``
                    attribute of the input field.
+                   It may be nested like ``defaults``.
     :returns: rendered forms
 
     This extension provides the additional variables in the Jinja2 environment:
@@ -62,6 +75,7 @@ class FormFillExtension(jinja2.ext.Extension):
        This property accepts the same arguments of
        :func:`formencode.htmlfill.render`, except ``form``, ``defaults``,
        ``errors`` and ``error_formatters``.
+       It also accepts ``minify_whitespace``; see :func:`render`.
 
     .. attribute:: jinja2.Environment.formfill_error_formatters
 
@@ -71,6 +85,19 @@ class FormFillExtension(jinja2.ext.Extension):
 
        .. seealso:: http://www.formencode.org/en/latest/htmlfill.html#errors
 
+    **Thread safety:**
+
+    Templates that use ``formfill`` can be rendered from many threads
+    sharing one :class:`jinja2.Environment`.  Every block is filled by its
+    own :class:`FormFillParser`, because parsers hold the state of a single
+    document and can't be shared.  :attr:`~jinja2.Environment.formfill_config`
+    and :attr:`~jinja2.Environment.formfill_error_formatters` are copied
+    when each block starts to render, and only the block's parser holds the
+    copies.  So a block always sees a consistent snapshot of each of them
+    even if another thread changes them meanwhile, though a change of both
+    at once may be seen half applied.  It's still recommended to configure
+    them only before serving requests.
+
     """
     tags = frozenset(['formfill'])
 
@@ -98,17 +125,261 @@ class FormFillExtension(jinja2.ext.Extension):
             defaults = {}
         if isinstance(errors, jinja2.runtime.Undefined):
             errors = {}
-        if not isinstance(defaults, collections.Mapping):
+        if not isinstance(defaults, Mapping):
             raise TypeError("argument 'defaults' should be "
                             "collections.Mapping, not {0!r}".format(defaults))
-        if not isinstance(errors, collections.Mapping):
+        if not isinstance(errors, Mapping):
             raise TypeError("argument 'errors' should be collections.Mapping, "
                             "not {0!r}".format(errors))
+        config = dict(self.environment.formfill_config)
+        error_formatters = dict(self.environment.formfill_error_formatters)
         rv = caller()
-        return formencode.htmlfill.render(
-            rv, defaults, errors,
-            error_formatters=self.environment.formfill_error_formatters,
-            **self.environment.formfill_config)
+        return render(rv, defaults, errors,
+                      error_formatters=error_formatters, **config)
+
+
+class FormFillParser(formencode.htmlfill.FillingParser):
+    """:class:`formencode.htmlfill.FillingParser` that can also collapse
+    insignificant whitespace between tags while it fills the form.
+
+    :param minify_whitespace: if it is ``True``, every text run that consists
+                              only of whitespace (e.g. indentation between
+                              tags) is collapsed into a single character:
+                              a newline if the run contains one, or a space
+                              otherwise.  Contents of ``<pre>`` and
+                              ``<textarea>`` are preserved.
+
+    Other arguments are the same as
+    :class:`~formencode.htmlfill.FillingParser`, except that ``defaults``
+    and ``errors`` are wrapped in :class:`NestedMapping` if they are
+    mappings.
+
+    """
+
+    preserve_whitespace_tags = frozenset(['pre', 'textarea'])
+
+    def __init__(self, defaults, errors=None, minify_whitespace=False,
+                 **kwargs):
+        if isinstance(defaults, Mapping):
+            defaults = NestedMapping(defaults)
+        if isinstance(errors, Mapping):
+            errors = NestedMapping(errors, leaf_lists=False)
+        formencode.htmlfill.FillingParser.__init__(self, defaults, errors,
+                                                   **kwargs)
+        self.minify_whitespace = minify_whitespace
+        self.preserve_depth = 0
+        self.last_whitespace = None
+        self.text_since_whitespace = True
+
+    def handle_starttag(self, tag, attrs, startend=False):
+        if tag in self.preserve_whitespace_tags and not startend:
+            self.preserve_depth += 1
+        formencode.htmlfill.FillingParser.handle_starttag(self, tag, attrs,
+                                                          startend)
+
+    def handle_endtag(self, tag):
+        if tag in self.preserve_whitespace_tags and self.preserve_depth:
+            self.preserve_depth -= 1
+        formencode.htmlfill.FillingParser.handle_endtag(self, tag)
+
+    def handle_data(self, data):
+        minify = self.minify_whitespace and not self.preserve_depth
+        if not (minify and WHITESPACE_PATTERN.match(data)):
+            return formencode.htmlfill.FillingParser.handle_data(self, data)
+        # Flush the source up to here, then emit the collapsed whitespace
+        # and move the source position past the original run.
+        self.write_pos()
+        if not self.skip_output():
+            self.write_whitespace(u'\n' if u'\n' in data else u' ')
+        line, offset = self.getpos()
+        newlines = data.count(u'\n')
+        if newlines:
+            offset = len(data) - data.rfind(u'\n') - 1
+            self.source_pos = line + newlines, offset
+        else:
+            self.source_pos = line, offset + len(data)
+
+    def write_text(self, text):
+        formencode.htmlfill.FillingParser.write_text(self, text)
+        if text:
+            self.text_since_whitespace = True
+
+    def write_whitespace(self, whitespace):
+        # Runs separated only by removed tags (e.g. <form:iferror>) are
+        # merged into the previously written one.
+        if not self.text_since_whitespace:
+            if whitespace == u'\n':
+                self._content[self.last_whitespace] = whitespace
+            return
+        self.last_whitespace = len(self._content)
+        self.write_text(whitespace)
+        self.text_since_whitespace = False
+
+
+class NestedMapping(Mapping):
+    """Read-only :term:`mapping` view of nested ``defaults`` or ``errors``,
+    keyed by field names in the :mod:`formencode.variabledecode` style.
+
+    A field name like ``items-17.qty`` is resolved on demand into
+    ``data['items'][17]['qty']``, so that nested values don't have to be
+    flattened by :func:`formencode.variabledecode.variable_encode` before
+    rendering.  Each lookup costs only as much as the depth of the name,
+    regardless of the size of the data.
+
+    .. code-block:: pycon
+
+       >>> m = NestedMapping({'items': [{'qty': 3}, {'qty': 5}]})
+       >>> m['items-1.qty']
+       5
+
+    A key that exists as is takes precedence, so flat mappings work as
+    before.  Iterating yields flattened names of the leaf values, and
+    nested ``None`` items (e.g. of valid rows in
+    :meth:`formencode.api.Invalid.unpack_errors`) are skipped.
+
+    Unlike lookups, iterating and :meth:`copy` walk the whole data.
+    :class:`FormFillParser` does it for ``errors`` once per form to find
+    unused errors, if ``auto_insert_errors`` or ``use_all_keys`` is set,
+    and for ``defaults`` only if ``use_all_keys`` is set.
+
+    :param data: a nested :term:`mapping`
+    :param leaf_lists: if it is ``True`` (default), lists of non-container
+                       values are leaves, as values of multiple ``select``
+                       in ``defaults``.  Otherwise they are flattened by
+                       index (e.g. ``emails-1``) as
+                       :func:`~formencode.variabledecode.variable_encode`
+                       does, for error lists of :class:`formencode.ForEach`
+                       in ``errors``.
+
+    """
+
+    def __init__(self, data, leaf_lists=True):
+        self.data = data
+        self.leaf_lists = leaf_lists
+
+    def __getitem__(self, key):
+        data = self.data
+        if key in data:
+            return data[key]
+        if not isinstance(key, string_types):
+            raise KeyError(key)
+        try:
+            for part in key.split('.'):
+                data = self._lookup(data, part)
+        except (KeyError, IndexError, TypeError):
+            raise KeyError(key)
+        return data
+
+    def _lookup(self, container, part):
+        if isinstance(container, Mapping) and part in container:
+            return container[part]
+        match = INDEXED_NAME_PATTERN.match(part)
+        if match is None:
+            raise KeyError(part)
+        container = self._lookup(container, match.group(1))
+        if not isinstance(container, (list, tuple)):
+            raise KeyError(part)
+        return container[int(match.group(2))]
+
+    def __iter__(self):
+        for key, value in self.iteritems():
+            yield key
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __nonzero__(self):
+        return bool(self.data)
+
+    __bool__ = __nonzero__
+
+    def iteritems(self):
+        """Iterate pairs of the flattened name and the leaf value."""
+        return self._flatten(self.data, u'')
+
+    def _flatten(self, container, prefix):
+        if isinstance(container, Mapping):
+            items = ((u'{0}.{1}'.format(prefix, k) if prefix else k, v)
+                     for k, v in container.items())
+        else:
+            items = ((u'{0}-{1}'.format(prefix, i), v)
+                     for i, v in enumerate(container))
+        for key, value in items:
+            if self._is_branch(value):
+                for pair in self._flatten(value, key):
+                    yield pair
+            elif value is not None or not prefix:
+                yield key, value
+
+    def _is_branch(self, value):
+        if isinstance(value, Mapping):
+            return True
+        if not isinstance(value, (list, tuple)):
+            return False
+        if not self.leaf_lists:
+            return True
+        return any(isinstance(v, (Mapping, list, tuple))
+                   for v in value)
+
+    def copy(self):
+        """Return the flattened :class:`dict`."""
+        return dict(self.iteritems())
+
+
+def render(form, defaults=None, errors=None, auto_insert_errors=True,
+           auto_error_formatter=None, **kwargs):
+    """Fill the ``form`` using :class:`FormFillParser`.
+
+    It takes the same arguments as :func:`formencode.htmlfill.render`, and
+    additionally ``minify_whitespace`` of :class:`FormFillParser`.
+
+    """
+    if defaults is None:
+        defaults = {}
+    if auto_insert_errors and auto_error_formatter is None:
+        auto_error_formatter = formencode.htmlfill.default_formatter
+    parser = FormFillParser(defaults, errors,
+                            auto_error_formatter=auto_error_formatter,
+                            **kwargs)
+    parser.feed(form)
+    parser.close()
+    return parser.text()
+
+
+def warm_up(environment, extensions=None, filter_func=None):
+    """Load and compile every template of the ``environment``'s loader
+    ahead of the first request, e.g. in the master process of a pre-forking
+    server so that workers share the compiled templates.
+
+    ``extensions`` and ``filter_func`` are the same as
+    :meth:`jinja2.Environment.list_templates`.  A template that fails to
+    load, e.g. because of a syntax error or a binary file, doesn't stop
+    the others.
+
+    Note that :attr:`jinja2.Environment.cache_size` should be large enough
+    to keep all of them.
+
+    :param environment: a :class:`jinja2.Environment` to warm up
+    :returns: a list of triples of the template name, the seconds spent on
+              it, and the exception raised while loading it or ``None``
+
+    """
+    timings = []
+    for name in environment.list_templates(extensions, filter_func):
+        start = timeit.default_timer()
+        try:
+            environment.get_template(name)
+        except (jinja2.TemplateError, UnicodeDecodeError) as e:
+            error = e
+        else:
+            error = None
+        timings.append((name, timeit.default_timer() - start, error))
+    return timings
+
+
+# formencode_jinja2.formfill is FormFillExtension itself, so make it
+# reachable through that name as well.
+FormFillExtension.warm_up = staticmethod(warm_up)
 
 
 def default_formatter(error):
@@ -117,6 +388,10 @@ def default_formatter(error):
     return u'<span class="error-message">{0}</span>'.format(quoted)
 
 
+INDEXED_NAME_PATTERN = re.compile(r'(.+)-(\d+)\Z')
+
+WHITESPACE_PATTERN = re.compile(r'[ \t\n\r\f]+\Z')
+
 DEFAULT_ERROR_FORMATTERS = dict(formencode.htmlfill.default_formatter_dict)
 DEFAULT_ERROR_FORMATTERS.update(
     default=default_formatter,
@@ -1,7 +1,10 @@
 # -*- coding: utf-8 -*-
+import threading
+import timeit
 import pytest
 import jinja2
-from formfill import FormFillExtension
+import formencode_jinja2
+from .formfill import FormFillExtension, render, warm_up
 
 
 @pytest.fixture
@@ -228,3 +231,213 @@ def test_undefined_variables(jinja_env):
     </form>'''
     result = jinja_env.from_string(template).render()
     assert result == expected
+
+
+def test_minify_whitespace(jinja_env):
+    jinja_env.formfill_config.update(minify_whitespace=True)
+    template = u'''
+    {% formfill {'username': 'john doe', 'memo': 'a\n    b'}
+           with {'username': 'Invalid Username'} -%}
+    <form action="account/signin" method="POST">
+        <input type="text" name="username" />   <form:error name="username">
+        <pre>
+  keep   this </pre>
+        <textarea name="memo"></textarea>
+        <p>&nbsp;  <b>bold</b> text  </p>
+        <form:iferror name="username">
+            <b>Check your name</b>
+        </form:iferror>  <form:iferror name="password">
+            <b>Check your password</b>
+        </form:iferror>
+        <select name="lang"></select>
+    </form>
+    {%- endformfill %}'''
+    expected = u'''
+    <form action="account/signin" method="POST">
+<input type="text" name="username" class="error" value="john doe" /> \
+<span class="error-message">Invalid Username</span>
+<pre>
+  keep   this </pre>
+<textarea name="memo">a
+    b</textarea>
+<p>&nbsp; <b>bold</b> text  </p>
+<b>Check your name</b>
+<select name="lang"></select>
+</form>'''
+    result = jinja_env.from_string(template).render()
+    assert result == expected
+
+
+def test_nested_defaults_and_errors(jinja_env):
+    template = u'''
+    {% formfill {'items': [{'qty': 3}, {'qty': 5, 'note': 'fragile'}],
+                 'tags': ['b', 'c'], 'order.memo': 'asap'}
+           with {'items': [None, {'qty': 'Too many'}]} -%}
+    <form action="order" method="POST">
+        <input type="text" name="items-0.qty" />
+        <input type="text" name="items-1.qty" />
+        <form:error name="items-1.qty">
+        <input type="text" name="items-1.note" />
+        <input type="text" name="items-2.qty" />
+        <input type="checkbox" name="tags" value="a" />
+        <input type="checkbox" name="tags" value="b" />
+        <input type="text" name="order.memo" />
+    </form>
+    {%- endformfill %}'''
+    expected = u'''
+    <form action="order" method="POST">
+        <input type="text" name="items-0.qty" value="3" />
+        <input type="text" name="items-1.qty" class="error" value="5" />
+        <span class="error-message">Too many</span>
+        <input type="text" name="items-1.note" value="fragile" />
+        <input type="text" name="items-2.qty" value="" />
+        <input type="checkbox" name="tags" value="a" />
+        <input type="checkbox" name="tags" value="b" checked="checked" />
+        <input type="text" name="order.memo" value="asap" />
+    </form>'''
+    result = jinja_env.from_string(template).render()
+    assert result == expected
+
+
+def test_concurrent_rendering(jinja_env):
+    def list_error_formatter(error):
+        return u'<ul class="errors"><li>{0}</li></ul>'.format(error)
+    default_formatter = jinja_env.formfill_error_formatters['default']
+    template = jinja_env.from_string(u'''
+    {%- formfill {} with errors -%}
+    {%- for i in range(100) %}
+    <input type="text" name="field{{ i }}" />
+    <form:error name="field{{ i }}">
+    {%- endfor %}
+    {%- endformfill %}''')
+    errors = dict(('field{0}'.format(i), 'Error {0}'.format(i))
+                  for i in range(100))
+    settings = [(error_class, formatter)
+                for error_class in ('error', 'fail')
+                for formatter in (default_formatter, list_error_formatter)]
+    expected = set()
+    for error_class, formatter in settings:
+        jinja_env.formfill_config['error_class'] = error_class
+        jinja_env.formfill_error_formatters['default'] = formatter
+        expected.add(template.render(errors=errors))
+    assert len(expected) == len(settings)
+    failures = []
+    done = threading.Event()
+
+    def render():
+        for i in range(20):
+            result = template.render(errors=errors)
+            if result not in expected:
+                failures.append(result)
+
+    def configure():
+        while not done.is_set():
+            for error_class, formatter in settings:
+                jinja_env.formfill_config['error_class'] = error_class
+                jinja_env.formfill_error_formatters['default'] = formatter
+
+    renderers = [threading.Thread(target=render) for n in range(4)]
+    configurer = threading.Thread(target=configure)
+    configurer.start()
+    for thread in renderers:
+        thread.start()
+    for thread in renderers:
+        thread.join()
+    done.set()
+    configurer.join()
+    assert not failures
+
+
+def test_warm_up():
+    class Loader(jinja2.DictLoader):
+        def __init__(self, mapping):
+            super(Loader, self).__init__(mapping)
+            self.loaded = []
+
+        def get_source(self, environment, template):
+            self.loaded.append(template)
+            return super(Loader, self).get_source(environment, template)
+
+    loader = Loader({
+        'signin.html': u'{% formfill {} %}<input name="username" />'
+                       u'{% endformfill %}',
+        'layout.html': u'<html>{% block body %}{% endblock %}</html>',
+        'broken.html': u'{% formfill %}{% endformfill %}',
+        'robots.txt': u'User-agent: *',
+    })
+    env = jinja2.Environment(loader=loader, extensions=[FormFillExtension])
+    overlay = env.overlay()
+    warm_up(overlay, extensions=['html'])
+    del loader.loaded[:]
+    overlay.get_template('signin.html').render()
+    assert loader.loaded == []
+    timings = warm_up(env, extensions=['html'])
+    assert sorted(loader.loaded) == ['broken.html', 'layout.html',
+                                     'signin.html']
+    assert sorted(name for name, _, _ in timings) == ['broken.html',
+                                                      'layout.html',
+                                                      'signin.html']
+    assert all(seconds >= 0 for _, seconds, _ in timings)
+    errors = dict((name, error) for name, _, error in timings)
+    assert isinstance(errors.pop('broken.html'), jinja2.TemplateSyntaxError)
+    assert errors == {'layout.html': None, 'signin.html': None}
+    del loader.loaded[:]
+    env.get_template('signin.html').render()
+    assert loader.loaded == []
+
+
+def test_warm_up_through_package():
+    loader = jinja2.DictLoader({'signin.html': u'<input name="username" />'})
+    env = jinja2.Environment(loader=loader,
+                             extensions=[formencode_jinja2.formfill])
+    timings = formencode_jinja2.formfill.warm_up(env)
+    assert [name for name, _, _ in timings] == ['signin.html']
+
+
+def test_nested_errors_auto_insert(jinja_env):
+    template = u'''
+    {% formfill {'emails': ['a', 'b']}
+           with {'emails': [None, 'Bad'],
+                 'items': [None, {'qty': 'Too many'}]} -%}
+    <input type="text" name="emails-0" />
+    <input type="text" name="emails-1" />
+    {%- endformfill %}'''
+    expected = u'''
+    <!-- for: items-1.qty -->
+<span class="error-message">Too many</span><br />
+<input type="text" name="emails-0" value="a" />
+    <!-- for: emails-1 -->
+<span class="error-message">Bad</span><br />
+<input type="text" name="emails-1" class="error" value="b" />'''
+    result = jinja_env.from_string(template).render()
+    assert result == expected
+    jinja_env.formfill_config.update(auto_insert_errors=False)
+    result = jinja_env.from_string(template).render()
+    assert 'error-message' not in result
+
+
+def test_nested_defaults_use_all_keys(jinja_env):
+    jinja_env.formfill_config.update(use_all_keys=True)
+    template = jinja_env.from_string(u'''
+    {% formfill defaults -%}
+    <input type="text" name="items-0.qty" />
+    <input type="text" name="items-1.qty" />
+    <select name="tags" multiple="multiple"></select>
+    {%- endformfill %}''')
+    template.render(defaults={'items': [{'qty': 1}, {'qty': 2}],
+                              'tags': ['a', 'b']})
+    with pytest.raises(AssertionError) as exc:
+        template.render(defaults={'items': [{'qty': 1}, {'qty': 2},
+                                            {'qty': 3}]})
+    assert 'items-2.qty' in str(exc.value)
+
+
+def test_minify_whitespace_many_removed_tags():
+    form = u'<form>\n' + u''.join(
+        u'    <form:error name="field{0}">\n'.format(i)
+        for i in range(20000)) + u'</form>'
+    start = timeit.default_timer()
+    result = render(form, minify_whitespace=True)
+    elapsed = timeit.default_timer() - start
+    assert result == u'<form>\n</form>'
+    assert elapsed < 5